@@ -1,6 +1,9 @@
 import os
 import geopandas as gpd 
+import numpy as np
 import pandas as pd
+import pyogrio
+import shapely
 import multiprocessing as mp
 
 class Estuary:
@@ -12,16 +15,14 @@ class Estuary:
         for cf in cfs:
             tmp = Estuary.getEstuaryMarine(folder, cf)
             if len(tmp) > 0:
-                est_list.append(tmp.copy())
+                est_list.append(tmp)
                 print(f"{cf}: added {len(tmp)} records")
             else:
                 print(f"{cf}: no records")
-            del tmp
 
         # concat into one dataframe
-        est_gdf = pd.concat(est_list).pipe(gpd.GeoDataFrame)
+        est_gdf = gpd.GeoDataFrame(pd.concat(est_list, ignore_index=True, copy=False), crs="EPSG:5070", geometry='geometry')
         del est_list
-        est_gdf.crs = "EPSG:5070"
 
         est_gdf.to_file(outpath)
 
@@ -40,32 +41,33 @@ class Estuary:
         gdf = gdf[gdf['lu_code']==1100]
 
         # return 
-        return gdf
+        return gdf.reset_index(drop=True)
 
 class Lotic:
     def run_lotic(folder, local_folder, threshold, facet_path):
-        outpath = f"{local_folder}/data/input/lotic_reservoirs_1m.shp"
-        # read in lotic polys for each county
+        outpath = f"{local_folder}/data/input/lotic_reservoirs_1m.gpkg"
+        # read in lotic polys for each county - counties are independent, so read them in parallel
         lotic_list = []
-        for cf in os.listdir(folder):
-            tmp = Lotic.get_lotic_and_reservoirs(folder, cf, threshold)
-            if len(tmp) > 0:
-                lotic_list.append(tmp.copy())
-                print(f"{cf}: added {len(tmp)} records")
-            else:
-                print(f"{cf}: no records")
-            del tmp
+        county_iterator = [(folder, cf, threshold) for cf in os.listdir(folder)]
+        with mp.Pool(processes=os.cpu_count()) as pool:
+            for cf, tmp in pool.imap_unordered(load_lotic, county_iterator):
+                if len(tmp) > 0:
+                    lotic_list.append(tmp)
+                    print(f"{cf}: added {len(tmp)} records")
+                else:
+                    print(f"{cf}: no records")
+            pool.close()
+            pool.join()
 
         # concat into one dataframe
-        lotic_gdf = pd.concat(lotic_list).pipe(gpd.GeoDataFrame)
+        lotic_gdf = gpd.GeoDataFrame(pd.concat(lotic_list, ignore_index=True, copy=False), crs="EPSG:5070", geometry='geometry')
         del lotic_list
-        lotic_gdf.crs = "EPSG:5070"
 
         # remove features not connected to the stream network
         lotic_gdf = Lotic.remove_disconnected_features(facet_path, lotic_gdf)
 
-        # write results
-        lotic_gdf.to_file(outpath)
+        # write results - arrow-backed batch write to GeoPackage (no 2 GB DBF cap or 10 char field names)
+        pyogrio.write_dataframe(lotic_gdf, outpath, layer='lotic', driver='GPKG', use_arrow=True)
 
     def get_lotic_and_reservoirs(folder, cf, threshold):
         # set path and verify data exists
@@ -73,20 +75,18 @@ class Lotic:
         if not os.path.isfile(lotic_path):
             return []
 
-        # read in water for county
-        gdf = gpd.read_file(lotic_path, layer='water')
-
-        # select lotic water and reservoirs
-        gdf = gdf[['lu_code', 'geometry']]
-        gdf.loc[:, 'lu_code'] = gdf.lu_code.astype(int)
-        gdf = gdf[gdf['lu_code'].isin([1300, 1210])]
+        # read in lotic water and reservoirs for county - column and attribute filters are pushed down to OGR
+        gdf = pyogrio.read_dataframe(lotic_path, layer='water', columns=['lu_code'], where="lu_code IN (1210, 1300)", use_arrow=True)
+        gdf['lu_code'] = gdf['lu_code'].astype(int)
 
         # remove small lotic water features
-        gdf.loc[:, 'acres'] = gdf.geometry.area / 4046.86
-        gdf = gdf[(gdf['lu_code']==1210)|((gdf['lu_code']==1300)&(gdf['acres']>=threshold))]
+        acres = shapely.area(gdf.geometry.values) / 4046.86
+        lu_code = gdf['lu_code'].to_numpy()
+        gdf['acres'] = acres
+        gdf = gdf[(lu_code == 1210) | ((lu_code == 1300) & (acres >= threshold))]
         
         # return lotic water in county
-        return gdf[['lu_code','acres','geometry']]
+        return gdf[['lu_code','acres','geometry']].reset_index(drop=True)
 
     def remove_disconnected_features(facet_path, lotic_gdf):
         """
@@ -97,19 +97,26 @@ class Lotic:
                 lotic_gdf - geodataframe of lotic water and reservoirs from LULC
         Returns: lotic_gdf
         """
-        # 1. read in FACET streams
-        facet = gpd.read_file(facet_path, bbox=lotic_gdf.envelope)
-
-        # 2. Get list of lotic features that intersect FACET
-        lotic_gdf.loc[:, 'id'] = [int(x) for x in range(len(lotic_gdf))]
-        lotic_ids = sjoin_mp(lotic_gdf[['id','geometry']], 'intersects', facet[['geometry']])
-        lotic_ids = list(lotic_ids['id'])
-        del facet
-
-        # 3. select lotic features intersecting facet
-        print(f"Removing {len(lotic_gdf) - len(lotic_ids)} disconnected features")
-        lotic_gdf = lotic_gdf[lotic_gdf['id'].isin(lotic_ids)]
-        del lotic_ids
+        # 1. read in FACET stream geometry - scalar bbox so OGR can use the spatial index, no attributes needed
+        facet = pyogrio.read_dataframe(facet_path, bbox=tuple(lotic_gdf.total_bounds), columns=[], use_arrow=True)
+
+        # 2. Drop lotic features whose bbox falls outside the FACET extent before the spatial join
+        lotic_gdf['id'] = np.arange(len(lotic_gdf), dtype=np.int64)
+        minx, miny, maxx, maxy = facet.total_bounds
+        bx = shapely.bounds(lotic_gdf.geometry.values)
+        in_extent = (bx[:, 0] <= maxx) & (bx[:, 2] >= minx) & (bx[:, 1] <= maxy) & (bx[:, 3] >= miny)
+
+        # 3. Get lotic features that intersect FACET - one STRtree over FACET, queried with all candidates at once
+        candidates = np.flatnonzero(in_extent)
+        tree = shapely.STRtree(facet.geometry.values)
+        left_idx, right_idx = tree.query(lotic_gdf.geometry.values[candidates], predicate='intersects')
+        keep = candidates[np.unique(left_idx)]
+        del facet, tree, left_idx, right_idx
+
+        # 4. select lotic features intersecting facet
+        print(f"Removing {len(lotic_gdf) - len(keep)} disconnected features")
+        lotic_gdf = lotic_gdf.iloc[keep]
+        del keep
 
         return lotic_gdf
 
@@ -118,71 +125,38 @@ class FACET:
         outpath = f"{local_folder}/data/input/FACET_100k_gapfilled_cleaned.shp"
         # 1. read in facet
         gdf = gpd.read_file(facet_path)
-        gdf.loc[:, 'id'] = [int(x) for x in range(len(gdf))]
+        gdf['id'] = np.arange(len(gdf), dtype=np.int64)
         gdf.loc[:, 'len'] = gdf['geometry'].length
         print(gdf[['geometry']])
 
-        # 2. sjoin segments
-        df = sjoin_mp(gdf[['id','geometry']], 'intersects', gdf[['id','geometry']], ['id_left','id_right'])
+        # 2. intersect segments with each other - the spatial index is built once on FACET and queried in bulk
+        left, right = gdf.sindex.query(gdf.geometry.values, predicate='intersects')
 
-        # 3. remove records where ids are the same - records are duplicated, only need unique list of left or right
-        print(df)
-        df = df[df['id_left'] != df['id_right']][['id_left']]
-        print(df)
-        ids = list(df['id_left'].unique())
-        del df
+        # 3. remove pairs where a segment matched itself - pairs are duplicated, only need unique list of left
+        ids = np.unique(gdf['id'].to_numpy()[left[left != right]])
+        del left, right
 
         # 4. remove records that are not touching another stream segment
         print(f"Removing {len(gdf) - len(ids)} records from {len(gdf)} stream segments...")
-        gdf = gdf[gdf['id'].isin(ids)]
+        gdf = gdf[np.isin(gdf['id'].to_numpy(), ids, assume_unique=True)]
         del ids
 
         # 5. write results
         gdf.to_file(outpath)
 
-def sjoin_mp(df1, sjoin_op, df2, cols):
-    """
-    Method: sjoin_mp6()
-    Purpose: Chunk and mp a sjoin function on specified geodataframes for specified operation,
-            retaining specified columns.
-    Params: df1 - geodataframe of data to chunk and sjoin (left gdf)
-            batch_size - integer value of max number of records to include in each chunk
-            sjoin_op - string of sjoin operation to use; 'intersects', 'within', 'contains'
-            cols - list of column names to retain
-            df2 - geodataframe of data to sjoin (right gdf)
-    Returns: sjoinSeg - df (or gdf) of sjoined data, with sjoin columns retained
-    """
-    NUM_CPUS, batch_size = 6, (int(len(df1) / 6) + 1)
-    print(f"{NUM_CPUS} batches of {batch_size} for {len(df1)} records")
-
-    chunk_iterator = []
-    for i in range(NUM_CPUS):
-        mn, mx = i * batch_size, (i + 1) * batch_size
-        gdf_args = df1[mn:mx], df2, sjoin_op, cols
-        chunk_iterator.append(gdf_args)
-
-    pool = mp.Pool(processes=NUM_CPUS)
-    sj_results = pool.map(sjoin, chunk_iterator)
-    pool.close()
-    sj_results = pd.concat(sj_results)
-    return sj_results
-
-def sjoin(args):
+def load_lotic(args):
     """
-    Method: sjoin_mp_pt5()
-    Purpose: Run sjoin on specified geodataframes for specified operation,
-            retaining specified columns.
+    Method: load_lotic()
+    Purpose: Pool worker to read lotic water and reservoirs for a single county.
     Params: args - tuple of arguments
-                df1 - geodataframe of data to sjoin (left gdf)
-                df2 - geodataframe of data to sjoin (right gdf)
-                sjoin_op - string of sjoin operation to use; 'intersects', 'within', 'contains'
-                sjoinCols - string of column names to retain, separated by a space
-    Returns: sjoinSeg - df (or gdf) of sjoined data, with sjoin columns retained
+                folder - path to county land use folders
+                cf - county folder name
+                threshold - min acres for lotic water features
+    Returns: cf - county folder name
+             gdf - gdf of lotic water and reservoirs for the county (empty list if no data)
     """
-    df1, df2, sjoin_op, cols = args 
-    sjoinSeg = gpd.sjoin(df1, df2, how='inner', op=sjoin_op)
-    sjoinSeg.drop_duplicates(inplace=True)
-    return sjoinSeg[cols]
+    folder, cf, threshold = args
+    return cf, Lotic.get_lotic_and_reservoirs(folder, cf, threshold)
 
 if __name__=="__main__":
     # paths
@@ -5,6 +5,8 @@ Author: Sarah McDonald, Geographer, USGS: Lower Mississippi-Gulf Water Science C
             Andy Fitch, and Sarah McDonald. 
 Contact: smcdonald@chesapeakebay.net
          rthompso@chesapeakebay.net
+Update: 
+              - Buffer method updated from GEODESIC to PLANAR
 Description: This script creates a 10-meter, binary, riparian mask for the specified extent. The riparian zone
              is delineated from four base datasets:
                 1. VIMS shoreline
@@ -40,16 +42,141 @@ How to Run: 1. The user must create the expected folder structure containing the
 
 import arcpy
 import datetime
+import math
+import numpy as np
 import os
 from sys import argv
 from timeit import default_timer as timer
 
+# vector steps and rasterization run in memory when the open source stack is installed, otherwise arcpy is used
+try:
+    import geopandas as gpd
+    import pandas as pd
+    import pyarrow # pyogrio reads with use_arrow
+    import pyogrio
+    import rasterio
+    import rasterio.features
+    import shapely
+    USE_SHAPELY = True
+except ImportError:
+    USE_SHAPELY = False
+
 def time_dif(st_time):
     cur = timer()
     end = round((cur - st_time)/60.0, 2)
     print(f"Run time: {end} minutes")
     return cur
 
+def read_vector(path, layer=None, columns=None):
+    """
+    Method: read_vector()
+    Purpose: Read a vector layer into a geodataframe, limited to the arcpy extent if one is set.
+    Params: path - path to vector data (shp, gpkg, or gdb); arcpy style gpkg paths (x.gpkg/main.layer) are accepted
+            layer - layer name in path (optional)
+            columns - list of attribute columns to read; None reads all, [] reads geometry only
+    Returns: gdf - geodataframe of features
+    """
+    if '.gpkg/' in path:
+        path, layer = path.split('.gpkg/')
+        path, layer = f"{path}.gpkg", layer.replace('main.', '', 1)
+    ext = arcpy.env.extent
+    bbox = (ext.XMin, ext.YMin, ext.XMax, ext.YMax) if ext else None
+    return pyogrio.read_dataframe(path, layer=layer, columns=columns, bbox=bbox, use_arrow=True)
+
+def buffer_dissolve(gdf, distance):
+    """
+    Method: buffer_dissolve()
+    Purpose: Planar buffer and dissolve features in memory (PairwiseBuffer with dissolve_option="ALL").
+    Params: gdf - geodataframe of features to buffer
+            distance - buffer distance in meters, or array of distances for each feature
+    Returns: geodataframe with a single dissolved buffer polygon
+    """
+    buffered = shapely.buffer(gdf.geometry.values, distance)
+    return gpd.GeoDataFrame(geometry=[shapely.union_all(buffered)], crs=gdf.crs)
+
+def erase_features(gdf, erase_gdf):
+    """
+    Method: erase_features()
+    Purpose: Erase features in memory (PairwiseErase). An STRtree over gdf finds the features each erase
+             feature intersects; only those are differenced and all other features are left untouched.
+    Params: gdf - geodataframe of features to erase from
+            erase_gdf - geodataframe of erase features
+    Returns: gdf - geodataframe with erase features removed; fully erased features are dropped
+    """
+    geoms = np.array(gdf.geometry.values, dtype=object)
+    erase_geoms = np.array(erase_gdf.geometry.values, dtype=object)
+
+    # 1. find candidate features intersecting each erase feature
+    tree = shapely.STRtree(geoms)
+    erase_idx, target_idx = tree.query(erase_geoms, predicate='intersects')
+
+    # 2. difference each candidate with the union of the erase features it intersects
+    if len(target_idx) > 0:
+        order = np.argsort(target_idx, kind='stable')
+        target_idx, erase_idx = target_idx[order], erase_idx[order]
+        hits, starts = np.unique(target_idx, return_index=True)
+        groups = np.split(erase_idx, starts[1:])
+        erasers = [erase_geoms[idx[0]] if len(idx) == 1 else shapely.union_all(erase_geoms[idx]) for idx in groups]
+        geoms[hits] = shapely.difference(geoms[hits], erasers)
+
+    # 3. drop features that were completely erased
+    gdf = gdf.set_geometry(gpd.GeoSeries(geoms, index=gdf.index, crs=gdf.crs))
+    return gdf[~shapely.is_empty(geoms)]
+
+def rasterize_riparian(layers, snap_raster, riparian_raster):
+    """
+    Method: rasterize_riparian()
+    Purpose: Burn the riparian layers into a single grid aligned to the snap raster (replaces Merge + PolygonToRaster).
+             Layers are projected to the snap raster CRS if needed and the grid is limited to the arcpy extent if one is set.
+    Params: layers - list of riparian geodataframes
+            snap_raster - path to snap raster, sets the cell size, alignment, and CRS
+            riparian_raster - path to output raster
+    Returns: N/A
+    """
+    with rasterio.open(snap_raster) as src:
+        snap_transform, crs = src.transform, src.crs
+
+    # 1. drop null and empty geometries and project layers that are not in the snap raster CRS
+    geoms_list = []
+    for gdf in layers:
+        if gdf.crs is not None and not gdf.crs.equals(crs.to_wkt()):
+            gdf = gdf.to_crs(crs.to_wkt())
+        geoms = np.array(gdf.geometry.values, dtype=object)
+        geoms = geoms[~(shapely.is_missing(geoms) | shapely.is_empty(geoms))]
+        if len(geoms) > 0:
+            geoms_list.append(geoms)
+    if not geoms_list:
+        print("No riparian features to rasterize")
+        return
+
+    bounds = np.array([shapely.total_bounds(geoms) for geoms in geoms_list])
+    minx, miny = bounds[:, 0].min(), bounds[:, 1].min()
+    maxx, maxy = bounds[:, 2].max(), bounds[:, 3].max()
+    ext = arcpy.env.extent
+    if ext:
+        minx, miny = max(minx, ext.XMin), max(miny, ext.YMin)
+        maxx, maxy = min(maxx, ext.XMax), min(maxy, ext.YMax)
+    if minx >= maxx or miny >= maxy:
+        print("No riparian features in the extent")
+        return
+
+    # 2. snap the extent of the riparian layers to the snap raster cells
+    col0, row0 = ~snap_transform * (minx, maxy)
+    col1, row1 = ~snap_transform * (maxx, miny)
+    col0, row0 = math.floor(col0), math.floor(row0)
+    transform = snap_transform * rasterio.transform.Affine.translation(col0, row0)
+    shape = (math.ceil(row1) - row0, math.ceil(col1) - col0)
+
+    # 3. burn each layer into the shared grid
+    out = np.zeros(shape, dtype=np.uint8)
+    for geoms in geoms_list:
+        rasterio.features.rasterize(geoms, out=out, transform=transform, default_value=1)
+
+    # 4. write once as a 1-bit raster
+    with rasterio.open(riparian_raster, 'w', driver='GTiff', height=shape[0], width=shape[1], count=1, dtype='uint8',
+                       crs=crs, transform=transform, nodata=0, compress='LZW', nbits=1) as dst:
+        dst.write(out, 1)
+
 def shoreline(vims_path, DE_path, FACET_path):
     """
     Method: shoreline()
@@ -57,26 +184,39 @@ def shoreline(vims_path, DE_path, FACET_path):
     Params: vims_path - path to VIMS shoreline
             DE_path - path to DE Bay shoreline
             FACET_path - path to original FACET layer
-    Returns: shoreline_riparian - layer name for shoreline riparian area
-             facet_erase - layer name for facet with shoreline erased
+    Returns: shoreline_riparian - layer name for shoreline riparian area (geodataframe when USE_SHAPELY)
+             facet_erase - layer name for facet with shoreline erased (geodataframe when USE_SHAPELY)
     """
-    # intermediate file names
-    buffer = 'shoreline_buffer'
-    shoreline = 'shoreline'
-    shoreline_riparian = 'shoreline_riparian'
-    facet_erase = 'FACET_shoreline_erase'
+    # intermediate file names - held in the memory workspace
+    buffer = 'memory/shoreline_buffer'
+    shoreline = 'memory/shoreline'
+    shoreline_riparian = 'memory/shoreline_riparian'
+    facet_erase = 'memory/FACET_shoreline_erase'
+
+    if USE_SHAPELY:
+        # 1. merge shoreline layers
+        shoreline_gdf = pd.concat([read_vector(vims_path, columns=[]), read_vector(DE_path, columns=[])], ignore_index=True)
 
-    # 1. merge shoreline layers
-    arcpy.management.Merge(inputs=[vims_path, DE_path], output=shoreline)
+        # 2. buffer shoreline
+        buffer_gdf = buffer_dissolve(shoreline_gdf, 30)
 
-    # 2. buffer shoreline
-    arcpy.analysis.PairwiseBuffer(in_features=shoreline, out_feature_class=buffer, buffer_distance_or_field="30 Meters", dissolve_option="ALL", dissolve_field=[], method="GEODESIC", max_deviation="0 Meters")
+        # 3. erase shoreline from buffer
+        shoreline_riparian = erase_features(buffer_gdf, shoreline_gdf)
 
-    # 3. erase shoreline from buffer
-    arcpy.analysis.PairwiseErase(in_features=buffer, erase_features=shoreline, out_feature_class=shoreline_riparian, cluster_tolerance="")
+        # 4. Erase buffered shoreline from FACET
+        facet_erase = erase_features(read_vector(FACET_path, columns=['chnwid_px']), buffer_gdf)
+    else:
+        # 1. merge shoreline layers
+        arcpy.management.Merge(inputs=[vims_path, DE_path], output=shoreline)
 
-    # 4. Erase buffered shoreline from FACET
-    arcpy.analysis.PairwiseErase(in_features=FACET_path, erase_features=buffer, out_feature_class=facet_erase, cluster_tolerance="")
+        # 2. buffer shoreline
+        arcpy.analysis.PairwiseBuffer(in_features=shoreline, out_feature_class=buffer, buffer_distance_or_field="30 Meters", dissolve_option="ALL", dissolve_field=[], method="PLANAR", max_deviation="0 Meters")
+
+        # 3. erase shoreline from buffer
+        arcpy.analysis.PairwiseErase(in_features=buffer, erase_features=shoreline, out_feature_class=shoreline_riparian, cluster_tolerance="")
+
+        # 4. Erase buffered shoreline from FACET
+        arcpy.analysis.PairwiseErase(in_features=FACET_path, erase_features=buffer, out_feature_class=facet_erase, cluster_tolerance="")
 
     # return layer names of vims riparian and updated facet
     return shoreline_riparian, facet_erase
@@ -86,23 +226,34 @@ def lotic(lotic_path, FACET_shoreline_erase):
     Method: lotic()
     Purpose: Create riparian zones for lotic water and remove lotic from FACET.
     Params: lotic_path - path to lotic water
-            FACET_shoreline_erase - layer name for intermediate file with shoreline erased from FACET
-    Returns: lotic_riparian - layer name of lotic riparian
-             FACET_shoreline_lotic_erase - layer name of FACET with shoreline and lotic erased
+            FACET_shoreline_erase - layer name for intermediate file with shoreline erased from FACET (geodataframe when USE_SHAPELY)
+    Returns: lotic_riparian - layer name of lotic riparian (geodataframe when USE_SHAPELY)
+             FACET_shoreline_lotic_erase - layer name of FACET with shoreline and lotic erased (geodataframe when USE_SHAPELY)
     """
-    # intermediate layer names
-    lotic_buf = 'lotic_buffer'
-    lotic_riparian = 'lotic_riparian'
-    FACET_shoreline_lotic_erase = "FACET_shoreline_lotic_erase"
+    # intermediate layer names - held in the memory workspace
+    lotic_buf = 'memory/lotic_buffer'
+    lotic_riparian = 'memory/lotic_riparian'
+    FACET_shoreline_lotic_erase = "memory/FACET_shoreline_lotic_erase"
+
+    if USE_SHAPELY:
+        # 1. Buffer lotic water to create lotic riparian zone
+        lotic_gdf = read_vector(lotic_path, columns=[])
+        lotic_buf_gdf = buffer_dissolve(lotic_gdf, 30)
+
+        # 2. Remove lotic water from FACET
+        FACET_shoreline_lotic_erase = erase_features(FACET_shoreline_erase, lotic_gdf)
 
-    # 1. Buffer lotic water to create lotic riparian zone
-    arcpy.analysis.PairwiseBuffer(in_features=lotic_path, out_feature_class=lotic_buf, buffer_distance_or_field="30 Meters", dissolve_option="ALL", dissolve_field=[], method="GEODESIC", max_deviation="0 Meters")
+        # 3. Remove lotic water from buffered lotic
+        lotic_riparian = erase_features(lotic_buf_gdf, lotic_gdf)
+    else:
+        # 1. Buffer lotic water to create lotic riparian zone
+        arcpy.analysis.PairwiseBuffer(in_features=lotic_path, out_feature_class=lotic_buf, buffer_distance_or_field="30 Meters", dissolve_option="ALL", dissolve_field=[], method="PLANAR", max_deviation="0 Meters")
 
-    # 2. Remove lotic water from FACET
-    arcpy.analysis.PairwiseErase(in_features=FACET_shoreline_erase, erase_features=lotic_path, out_feature_class=FACET_shoreline_lotic_erase, cluster_tolerance="")
+        # 2. Remove lotic water from FACET
+        arcpy.analysis.PairwiseErase(in_features=FACET_shoreline_erase, erase_features=lotic_path, out_feature_class=FACET_shoreline_lotic_erase, cluster_tolerance="")
 
-    # 3. Remove lotic water from buffered lotic
-    arcpy.analysis.PairwiseErase(in_features=lotic_buf, erase_features=lotic_path, out_feature_class=lotic_riparian, cluster_tolerance="")
+        # 3. Remove lotic water from buffered lotic
+        arcpy.analysis.PairwiseErase(in_features=lotic_buf, erase_features=lotic_path, out_feature_class=lotic_riparian, cluster_tolerance="")
 
     # 4. Return layer names for lotic riparian and FACET
     return lotic_riparian, FACET_shoreline_lotic_erase
@@ -111,18 +262,25 @@ def FACET(FACET_shoreline_lotic_erase):
     """
     Method: FACET()
     Purpose: Create FACET riparian area
-    Params: FACET_shoreline_lotic_erase - FACET layer to be buffered (FACET with shoreline and lotic erased)
-    Returns: facet_riparian - layer name of facet riparian
+    Params: FACET_shoreline_lotic_erase - FACET layer to be buffered (FACET with shoreline and lotic erased; geodataframe when USE_SHAPELY)
+    Returns: facet_riparian - layer name of facet riparian (geodataframe when USE_SHAPELY)
     """
-    # intermediate layer names
-    facet_riparian = 'FACET_riparian'
+    # intermediate layer names - held in the memory workspace
+    facet_riparian = 'memory/FACET_riparian'
 
-    # # # 1. Create field representing the channel width plus 30-m buffer area
-    arcpy.AddField_management(FACET_shoreline_lotic_erase, 'Buffer', "DOUBLE" ) # need this to avoid database lock error ?
-    arcpy.management.CalculateField(in_table=FACET_shoreline_lotic_erase, field="Buffer", expression="(!chnwid_px!/2)+30", expression_type="PYTHON3", code_block="", field_type="TEXT", enforce_domains="NO_ENFORCE_DOMAINS")
+    if USE_SHAPELY:
+        # 1-2. Buffer FACET by the channel width plus 30-m buffer area
+        facet = FACET_shoreline_lotic_erase
+        facet_riparian = buffer_dissolve(facet, facet['chnwid_px'].to_numpy(float) / 2.0 + 30.0)
+    else:
+        # 1. Create numeric field representing the channel width plus 30-m buffer area
+        oid = arcpy.Describe(FACET_shoreline_lotic_erase).OIDFieldName
+        arr = arcpy.da.TableToNumPyArray(FACET_shoreline_lotic_erase, [oid, 'chnwid_px'])
+        buf = np.rec.fromarrays([arr[oid], arr['chnwid_px'].astype(np.float64) / 2.0 + 30.0], names=[oid, 'Buffer'])
+        arcpy.da.ExtendTable(FACET_shoreline_lotic_erase, oid, buf, oid, append_only=False)
 
-    # 2. Buffer FACET
-    arcpy.analysis.PairwiseBuffer(in_features=FACET_shoreline_lotic_erase, out_feature_class=facet_riparian, buffer_distance_or_field="Buffer", dissolve_option="ALL", dissolve_field=[], method="GEODESIC", max_deviation="0 Meters")
+        # 2. Buffer FACET
+        arcpy.analysis.PairwiseBuffer(in_features=FACET_shoreline_lotic_erase, out_feature_class=facet_riparian, buffer_distance_or_field="Buffer", dissolve_option="ALL", dissolve_field=[], method="PLANAR", max_deviation="0 Meters")
 
     # 3. Return FACET riparian
     return facet_riparian
@@ -156,20 +314,26 @@ def createRiparian(vims_path, lotic_path, FACET_path, DE_path, snap_raster, outp
     facet_riparian = FACET(FACET_shoreline_lotic_erase)
     st = time_dif(st)
 
-    # 4. Merge the 3 riparian layers into a single feature layer
-    print(f"Merging riparian zones...{datetime.datetime.now()}")
-    arcpy.management.Merge(inputs=[shoreline_riparian, lotic_riparian, facet_riparian], output=rip_vector)
-    st = time_dif(st)
+    if USE_SHAPELY:
+        # 4-6. Rasterize the 3 riparian layers directly into the 10-meter grid - no merged vector
+        print(f"Creating riparian raster mask...{datetime.datetime.now()}")
+        rasterize_riparian([shoreline_riparian, lotic_riparian, facet_riparian], snap_raster, riparian_raster)
+        st = time_dif(st)
+    else:
+        # 4. Merge the 3 riparian layers into a single feature layer
+        print(f"Merging riparian zones...{datetime.datetime.now()}")
+        arcpy.management.Merge(inputs=[shoreline_riparian, lotic_riparian, facet_riparian], output=rip_vector)
+        st = time_dif(st)
 
-    # 5. Create field to rasterize on (all are 1)
-    arcpy.management.CalculateField(in_table=rip_vector, field="Raster", expression="1", expression_type="PYTHON3", field_type="SHORT")
+        # 5. Create field to rasterize on (all are 1)
+        arcpy.management.CalculateField(in_table=rip_vector, field="Raster", expression="1", expression_type="PYTHON3", field_type="SHORT")
 
-    # 6. Rasterize at 10-meters
-    print(f"Creating riparian raster mask...{datetime.datetime.now()}")
-    arcpy.env.snapRaster = snap_raster
-    arcpy.env.compression = "LZW"
-    arcpy.PolygonToRaster_conversion(rip_vector, "Raster", riparian_raster, cellsize=snap_raster)
-    st = time_dif(st)
+        # 6. Rasterize at 10-meters
+        print(f"Creating riparian raster mask...{datetime.datetime.now()}")
+        arcpy.env.snapRaster = snap_raster
+        arcpy.env.compression = "LZW"
+        arcpy.PolygonToRaster_conversion(rip_vector, "Raster", riparian_raster, cellsize=snap_raster)
+        st = time_dif(st)
 
 
 if __name__=="__main__":
@@ -180,10 +344,13 @@ if __name__=="__main__":
 
     # file paths
     vims_path = f"{input_folder}/VIMSChesBayShoreline_albers.shp"
-    lotic_path = f"{input_folder}/lotic_reservoirs_1m.shp"
+    lotic_path = f"{input_folder}/lotic_reservoirs_1m.gpkg/main.lotic"
     DE_path = f"{input_folder}/DE-shoreline_LULC-NOAASLR0ft_albers.shp"
     FACET_path = f"{input_folder}/FACET_NHD100k_aligned_w_gaps_filled_v1.shp"
     snap_raster = f"{input_folder}/environment/Phase6_Snap.tif"
+
+    # buffers are PLANAR - inputs must be in a projected (Albers) coordinate system
+    assert arcpy.Describe(vims_path).spatialReference.type == "Projected", "Inputs must be projected for PLANAR buffers"
     
     # optional user entry - path to extent mask
     extent = f"{input_folder}/environment/MDHWA_catchments_30m_albers.tif" # test in Patuxent
@@ -196,6 +363,7 @@ if __name__=="__main__":
         print("WARNING: Geodatabase already exists. Overwriting contents.")
         arcpy.env.overwriteOutput = True
     arcpy.env.workspace = f"{output_folder}/riparian_intermediates{suffix}.gdb"
+    arcpy.management.Delete("memory") # clear intermediates from previous runs
     if os.path.isfile(extent):
         arcpy.env.extent = extent
 
@@ -43,199 +43,504 @@ How to Run: 1. The user must create the expected folder structure containing the
 import arcpy
 from arcpy.sa import *
 import datetime
+import math
+import multiprocessing as mp
+import numpy as np
 import os
+import pathlib
+import shutil
+from functools import partial
 from sys import argv
 from timeit import default_timer as timer
 
+# shoreline buffer/erase runs in memory with shapely when it is installed, otherwise arcpy is used
+try:
+    import shapely
+    USE_SHAPELY = True
+except ImportError:
+    USE_SHAPELY = False
+
+# mosaic and COG output use the GDAL python bindings when they are installed, otherwise arcpy is used
+try:
+    from osgeo import gdal
+    gdal.UseExceptions()
+    USE_GDAL = True
+except ImportError:
+    USE_GDAL = False
+
+# final shoreline removal streams blocks through rasterio when it is installed, otherwise arcpy map algebra is used
+try:
+    import rasterio
+    import rasterio.windows
+    USE_RASTERIO = True
+except ImportError:
+    USE_RASTERIO = False
+
+# shoreline removal kernel is compiled with numba when it is installed, otherwise numpy is used
+try:
+    from numba import njit, prange
+    USE_NUMBA = True
+except ImportError:
+    USE_NUMBA = False
+
+# workspace for per-huc intermediates - hucs with more FACET features than the threshold use the huc gdb instead
+SCRATCH_WS = "memory"
+SCRATCH_MAX_FEATURES = 500000
+
 def time_dif(st_time):
     cur = timer()
     end = round((cur - st_time)/60.0, 2)
     print(f"\tRun time: {end} minutes")
     return cur
 
-def shoreline(vims_path, DE_path, FACET_data, huc_mask, buffer_width):
+def to_cog(src, dst):
     """
-    Method: shoreline()
-    Purpose: Create riparian zone for shoreline and remove buffered shoreline from FACET.
+    Method: to_cog()
+    Purpose: Convert a raster to a tiled, DEFLATE compressed Cloud-Optimized GeoTIFF with GDAL, compressing
+             blocks on all cpus. Without GDAL, arcpy writes a 512x512 tiled, LZW compressed 1-bit TIFF.
+    Params: src - path to input raster
+            dst - path to output COG
+    Returns: dst - path to output COG
+    """
+    if USE_GDAL:
+        gdal.Translate(dst, src, format="COG", creationOptions=["COMPRESS=DEFLATE", "NUM_THREADS=ALL_CPUS", "BLOCKSIZE=512"])
+    else:
+        with arcpy.EnvManager(tileSize="512 512", compression="LZW"):
+            arcpy.management.CopyRaster(src, dst, background_value=0, nodata_value=0, pixel_type='1_BIT', format="TIFF")
+    return dst
+
+def remove_shoreline_kernel(ras, vims, de, mask):
+    """
+    Method: remove_shoreline_kernel()
+    Purpose: Set riparian to 0 where VIMS or DE shoreline is present or outside the mask.
+    Params: ras - uint8 array of riparian
+            vims - boolean array, True where VIMS shoreline is present
+            de - boolean array, True where DE shoreline is present
+            mask - boolean array, True inside the mask
+    Returns: out - uint8 array of riparian with shoreline removed
+    """
+    return np.where(vims | de | ~mask, 0, ras).astype(np.uint8)
+
+if USE_NUMBA:
+    @njit(parallel=True, cache=True)
+    def remove_shoreline_kernel(ras, vims, de, mask):
+        out = np.empty(ras.shape, dtype=np.uint8)
+        for i in prange(ras.shape[0]):
+            for j in range(ras.shape[1]):
+                out[i, j] = 0 if vims[i, j] or de[i, j] or not mask[i, j] else ras[i, j]
+        return out
+
+def remove_shoreline(riparian_path, vims_ras, de_ras, mask, out_path):
+    """
+    Method: remove_shoreline()
+    Purpose: Remove VIMS and DE shoreline from the mosaicked riparian raster and impose the mask, reading and
+             writing 512x512 blocks with rasterio. The output covers the mask extent on the riparian grid.
+    Params: riparian_path - path to mosaicked (unmasked) riparian raster
+            vims_ras - path to rasterized VIMS shoreline
+            de_ras - path to rasterized DE shoreline
+            mask - path to mask raster
+            out_path - path to output riparian raster
+    Returns: out_path - path to output riparian raster
+    """
+    with rasterio.open(riparian_path) as r_src, rasterio.open(vims_ras) as v_src, rasterio.open(de_ras) as d_src, rasterio.open(mask) as m_src:
+        # 1. snap mask extent to the riparian grid
+        t = r_src.transform
+        col_off = math.floor((m_src.bounds.left - t.c) / t.a)
+        row_off = math.floor((m_src.bounds.top - t.f) / t.e)
+        width = math.ceil((m_src.bounds.right - t.c) / t.a) - col_off
+        height = math.ceil((m_src.bounds.bottom - t.f) / t.e) - row_off
+        transform = rasterio.windows.transform(rasterio.windows.Window(col_off, row_off, width, height), t)
+        profile = dict(driver="GTiff", dtype="uint8", count=1, width=width, height=height, crs=r_src.crs, transform=transform,
+                       nodata=0, nbits=1, compress="LZW", tiled=True, blockxsize=512, blockysize=512, BIGTIFF="IF_SAFER", NUM_THREADS="ALL_CPUS")
+
+        # 2. remove shoreline block by block - inputs are read by bounds, so they may have different extents
+        with rasterio.open(out_path, "w", **profile) as dst:
+            for _, window in dst.block_windows(1):
+                bounds = rasterio.windows.bounds(window, transform)
+                shape = (int(window.height), int(window.width))
+                ras = r_src.read(1, window=rasterio.windows.from_bounds(*bounds, r_src.transform), out_shape=shape, boundless=True, fill_value=0)
+                vims = ~np.ma.getmaskarray(v_src.read(1, window=rasterio.windows.from_bounds(*bounds, v_src.transform), out_shape=shape, boundless=True, masked=True))
+                de = ~np.ma.getmaskarray(d_src.read(1, window=rasterio.windows.from_bounds(*bounds, d_src.transform), out_shape=shape, boundless=True, masked=True))
+                msk = ~np.ma.getmaskarray(m_src.read(1, window=rasterio.windows.from_bounds(*bounds, m_src.transform), out_shape=shape, boundless=True, masked=True))
+                dst.write(remove_shoreline_kernel(ras.astype(np.uint8), vims, de, msk), 1, window=window)
+    return out_path
+
+def existing_layers(scratch=""):
+    """
+    Method: existing_layers()
+    Purpose: Snapshot the feature classes and rasters in the workspace (and the scratch workspace), so checkpoint
+             checks are set lookups rather than a catalog call each.
+    Params: scratch - workspace prefix for intermediates ("memory/" or "" for the huc gdb)
+    Returns: existing - set of feature class and raster names; scratch names carry the scratch prefix
+    """
+    existing = set(arcpy.ListFeatureClasses() or []) | set(arcpy.ListRasters() or [])
+    if scratch:
+        with arcpy.EnvManager(workspace=scratch.rstrip("/")):
+            existing |= {f"{scratch}{name}" for name in (arcpy.ListFeatureClasses() or []) + (arcpy.ListRasters() or [])}
+    return existing
+
+def has_rows(layer):
+    """
+    Method: has_rows()
+    Purpose: Check a feature class, layer, or selection for records by reading only the first row,
+             instead of counting the whole table.
+    Params: layer - feature class, layer, or selection to check
+    Returns: True if the layer has at least one record
+    """
+    with arcpy.da.SearchCursor(layer, ["OID@"]) as cursor:
+        return next(cursor, None) is not None
+
+def read_geometries(layer, fields=None):
+    """
+    Method: read_geometries()
+    Purpose: Read the geometries (and optional fields) of a feature class, layer, or selection into shapely.
+    Params: layer - feature class, layer, or selection to read
+            fields - list of field names to read with the geometry
+    Returns: geoms - array of shapely geometries
+             rows - list of field value tuples, one per geometry
+    """
+    fields = fields or []
+    with arcpy.da.SearchCursor(layer, ["SHAPE@WKB"] + fields) as cursor:
+        rows = [row for row in cursor if row[0] is not None]
+    geoms = shapely.from_wkb([bytes(row[0]) for row in rows])
+    return geoms, [row[1:] for row in rows]
+
+def write_geometries(geoms, name, geometry_type, template, fields=None, rows=None):
+    """
+    Method: write_geometries()
+    Purpose: Write shapely geometries (and optional field values) to a feature class in the workspace.
+             Empty geometries are skipped.
+    Params: geoms - array of shapely geometries
+            name - output feature class name
+            geometry_type - "POLYGON" or "POLYLINE"
+            template - feature class or layer providing the spatial reference (and the field definitions, if fields are written)
+            fields - list of field names to write; only these fields are created
+            rows - list of field value tuples, one per geometry
+    Returns: name - output feature class name
+    """
+    fields = fields or []
+    rows = rows if rows is not None else [()] * len(geoms)
+
+    # 1. create the feature class with only the written fields, typed as in the template
+    arcpy.management.CreateFeatureclass(os.path.dirname(name) or arcpy.env.workspace, os.path.basename(name), geometry_type, spatial_reference=template)
+    if fields:
+        field_types = {"Double": "DOUBLE", "Single": "FLOAT", "Integer": "LONG", "SmallInteger": "SHORT", "BigInteger": "BIGINTEGER", "String": "TEXT", "Date": "DATE"}
+        template_fields = {field.name: field for field in arcpy.ListFields(template)}
+        for f in fields:
+            arcpy.management.AddField(name, f, field_types[template_fields[f].type], field_length=template_fields[f].length)
+
+    # 2. drop empty geometries and convert the rest to WKB in one pass
+    keep = np.flatnonzero(~shapely.is_empty(geoms))
+    wkbs = shapely.to_wkb(geoms[keep])
+    with arcpy.da.InsertCursor(name, ["SHAPE@WKB"] + fields) as cursor:
+        for wkb, i in zip(wkbs, keep):
+            cursor.insertRow((wkb,) + tuple(rows[i]))
+    return name
+
+def erase_geometries(geoms, erase_geoms):
+    """
+    Method: erase_geometries()
+    Purpose: Erase geometries in memory (PairwiseErase). An STRtree over geoms finds the geometries each erase
+             geometry intersects; only those are differenced and all others are left untouched.
+    Params: geoms - array of shapely geometries to erase from
+            erase_geoms - array of shapely erase geometries
+    Returns: geoms - array of erased geometries (empty where completely erased)
+    """
+    geoms = geoms.copy()
+
+    # 1. find candidate geometries intersecting each erase geometry
+    tree = shapely.STRtree(geoms)
+    erase_idx, target_idx = tree.query(erase_geoms, predicate='intersects')
+
+    # 2. difference each candidate with the union of the erase geometries it intersects
+    if len(target_idx) > 0:
+        order = np.argsort(target_idx, kind='stable')
+        target_idx, erase_idx = target_idx[order], erase_idx[order]
+        hits, starts = np.unique(target_idx, return_index=True)
+        groups = np.split(erase_idx, starts[1:])
+        erasers = [erase_geoms[idx[0]] if len(idx) == 1 else shapely.union_all(erase_geoms[idx]) for idx in groups]
+        geoms[hits] = shapely.difference(geoms[hits], erasers)
+    return geoms
+
+def project_to_snap(fc, snap_sr, out_fc):
+    """
+    Method: project_to_snap()
+    Purpose: Project a feature class to the snap raster's coordinate system once, so geometries are not
+             projected on the fly in every huc. Coordinate systems are compared by their full WKT definition, so
+             custom coordinate systems (factory code 0) are not treated as equal.
+    Params: fc - path to feature class
+            snap_sr - spatial reference of the snap raster
+            out_fc - path to projected copy of fc
+    Returns: fc - path to fc if it already matches the snap raster, otherwise path to the projected copy
+             projected - True if the projected copy was written by this call
+    """
+    # exportToString is the WKT followed by the xy/z/m domains and tolerances - compare the WKT only
+    if arcpy.Describe(fc).spatialReference.exportToString().split(";")[0] == snap_sr.exportToString().split(";")[0]:
+        return fc, False
+    if arcpy.Exists(out_fc):
+        return out_fc, False
+    print(f"Projecting {os.path.basename(fc)} to the snap raster coordinate system")
+    arcpy.management.Project(fc, out_fc, snap_sr)
+    return out_fc, True
+
+def preclip_shoreline(vims_path, DE_path, huc_mask, preclip_folder, suffix):
+    """
+    Method: preclip_shoreline()
+    Purpose: Clip VIMS and DE Bay shoreline to a huc once, so huc workers read only their slice.
     Params: vims_path - path to VIMS shoreline
             DE_path - path to DE Bay shoreline
+            huc_mask - path to huc8 shapefile
+            preclip_folder - path to folder of pre-clipped inputs
+            suffix - huc suffix for file names
+    Returns: vims_clip - path to VIMS shoreline clipped to huc
+             de_clip - path to DE Bay shoreline clipped to huc
+    """
+    vims_clip = f"{preclip_folder}/VIMS_clip{suffix}.shp"
+    de_clip = f"{preclip_folder}/DE_clip{suffix}.shp"
+    if not arcpy.Exists(vims_clip):
+        arcpy.analysis.PairwiseClip(vims_path, huc_mask, vims_clip)
+    if not arcpy.Exists(de_clip):
+        arcpy.analysis.PairwiseClip(DE_path, huc_mask, de_clip)
+    return vims_clip, de_clip
+
+def preclip_facet(FACET_path, facet_layer, huc_mask, facet_tiled, suffix):
+    """
+    Method: preclip_facet()
+    Purpose: Clip FACET to a huc once, so huc workers open a small tile instead of selecting from the full layer.
+    Params: FACET_path - path to FACET gdb
+            facet_layer - FACET layer name in FACET_path
+            huc_mask - path to huc8 shapefile
+            facet_tiled - path to gdb of FACET tiles
+            suffix - huc suffix for file names
+    Returns: facet_clip - path to FACET clipped to huc
+    """
+    facet_clip = f"{facet_tiled}/facet{suffix}"
+    if not arcpy.Exists(facet_clip):
+        arcpy.analysis.PairwiseClip(f"{FACET_path}/{facet_layer}", huc_mask, facet_clip)
+    return facet_clip
+
+def shoreline(vims_clip, de_clip, FACET_data, buffer_width, scratch=""):
+    """
+    Method: shoreline()
+    Purpose: Create riparian zone for shoreline and remove buffered shoreline from FACET.
+    Params: vims_clip - path to VIMS shoreline clipped to huc
+            de_clip - path to DE Bay shoreline clipped to huc
             FACET - path to original FACET layer
-    Returns: shoreline_riparian - layer name for shoreline riparian area
-             facet_erase - layer name for facet with shoreline erased
+            scratch - workspace prefix for intermediates ("memory/" or "" for the huc gdb)
+    Returns: shoreline_riparian - layer name for shoreline riparian area (None if no shoreline in huc)
+             facet_erase - layer name for facet with shoreline erased (FACET_data if no shoreline in huc)
     """
     # intermediate file names
-    buffer = 'shoreline_buffer'
-    shoreline = 'shoreline'
-    shoreline_riparian = 'shoreline_riparian'
-    vims_clip = 'VIMS_clip'
-    de_clip = 'DE_clip'
-    facet_erase = 'FACET_shoreline_erase'
+    buffer = f'{scratch}shoreline_buffer'
+    shoreline = f'{scratch}shoreline'
+    shoreline_riparian = f'{scratch}shoreline_riparian'
+    facet_erase = f'{scratch}FACET_shoreline_erase'
+    existing = existing_layers(scratch)
+
+    if USE_SHAPELY:
+        if shoreline_riparian not in existing or facet_erase not in existing:
+            # 1. merge shoreline layers
+            shoreline_geoms = np.concatenate([read_geometries(vims_clip)[0], read_geometries(de_clip)[0]])
+            if len(shoreline_geoms) == 0: # no shoreline - pass FACET through unchanged
+                print("\t\tNo shoreline for HUC")
+                return None, FACET_data
+
+            # 2. buffer shoreline
+            buffer_geoms = np.array([shapely.union_all(shapely.buffer(shoreline_geoms, buffer_width))])
+
+            # 3. erase shoreline from buffer
+            write_geometries(erase_geometries(buffer_geoms, shoreline_geoms), shoreline_riparian, "POLYGON", vims_clip)
+
+            # 4. erase shoreline buffer from FACET
+            facet_geoms, facet_rows = read_geometries(FACET_data, ["chnwid_px"])
+            write_geometries(erase_geometries(facet_geoms, buffer_geoms), facet_erase, "POLYLINE", FACET_data, ["chnwid_px"], facet_rows)
+
+        # return layer names of vims riparian and updated facet
+        return shoreline_riparian, facet_erase
 
     # 1. merge shoreline layers
-    if not arcpy.Exists(f"{arcpy.env.workspace}/{shoreline}"):
-        # clip layers to huc
-        if int(arcpy.GetCount_management(vims_path).getOutput(0)) > 0:
-            arcpy.analysis.Clip(vims_path, huc_mask, vims_clip)
-        if int(arcpy.GetCount_management(DE_path).getOutput(0)) > 0:
-            arcpy.analysis.Clip(DE_path, huc_mask, de_clip)
-
-        # merge shoreline
-        if  arcpy.Exists(f"{arcpy.env.workspace}/{vims_clip}") and arcpy.Exists(f"{arcpy.env.workspace}/{de_clip}"):
-            arcpy.management.Merge(inputs=[vims_clip, de_clip], output=shoreline)
-        elif arcpy.Exists(f"{arcpy.env.workspace}/{vims_clip}"):
-            arcpy.management.CopyFeatures(vims_clip, shoreline)
-        elif arcpy.Exists(f"{arcpy.env.workspace}/{de_clip}"):
-            arcpy.management.CopyFeatures(de_clip, shoreline)
-        else: # no shoreline - just copy FACET and return
+    if shoreline not in existing:
+        # layers are pre-clipped to huc - keep those with records
+        inputs = [fc for fc in [vims_clip, de_clip] if has_rows(fc)]
+        if not inputs: # no shoreline - pass FACET through unchanged
             print("\t\tNo shoreline for HUC")
-            if not arcpy.Exists(f"{arcpy.env.workspace}/{facet_erase}"):
-                arcpy.management.CopyFeatures(FACET_data, facet_erase)
-            return shoreline_riparian, facet_erase
+            return None, FACET_data
+
+        # merge shoreline - append into an empty feature class with the VIMS schema
+        arcpy.management.CreateFeatureclass(os.path.dirname(shoreline) or arcpy.env.workspace, os.path.basename(shoreline), "POLYGON", template=vims_clip, spatial_reference=vims_clip)
+        arcpy.management.Append(inputs=inputs, target=shoreline, schema_type="NO_TEST")
 
     # 2. buffer shoreline
-    if not arcpy.Exists(f"{arcpy.env.workspace}/{buffer}"):
+    if buffer not in existing:
         arcpy.analysis.PairwiseBuffer(in_features=shoreline, out_feature_class=buffer, buffer_distance_or_field=f"{buffer_width} Meters", dissolve_option="ALL", dissolve_field=[], method="PLANAR", max_deviation="0 Meters")
 
     # 3. erase shoreline from buffer
-    if not arcpy.Exists(f"{arcpy.env.workspace}/{shoreline_riparian}"):
+    if shoreline_riparian not in existing:
         arcpy.analysis.PairwiseErase(in_features=buffer, erase_features=shoreline, out_feature_class=shoreline_riparian, cluster_tolerance="")
 
     # 4. erase shoreline buffer from FACET
-    if not arcpy.Exists(f"{arcpy.env.workspace}/{facet_erase}"):
+    if facet_erase not in existing:
         arcpy.analysis.PairwiseErase(in_features=FACET_data, erase_features=buffer, out_feature_class=facet_erase, cluster_tolerance="")
 
     # return layer names of vims riparian and updated facet
     return shoreline_riparian, facet_erase
 
-def lotic(lotic_path, FACET_shoreline_erase, buffer_width):
+def lotic(lotic_path, FACET_shoreline_erase, buffer_width, scratch=""):
     """
     Method: lotic()
     Purpose: Create riparian zones for lotic water and remove lotic from FACET.
     Params: lotic_path - path to lotic water
             FACET_shoreline_erase - layer name for intermediate file with shoreline erased from FACET
-    Returns: lotic_riparian - layer name of lotic riparian
-             FACET_shoreline_lotic_erase - layer name of FACET with shoreline and lotic erased
+            scratch - workspace prefix for intermediates ("memory/" or "" for the huc gdb)
+    Returns: lotic_riparian - layer name of lotic riparian (None if no lotic in huc)
+             FACET_shoreline_lotic_erase - layer name of FACET with shoreline and lotic erased (FACET_shoreline_erase if no lotic in huc)
     """
     # intermediate layer names
-    lotic_buf = 'lotic_buffer'
-    lotic_riparian = 'lotic_riparian'
-    FACET_shoreline_lotic_erase = "FACET_shoreline_lotic_erase"
+    lotic_buf = f'{scratch}lotic_buffer'
+    lotic_riparian = f'{scratch}lotic_riparian'
+    FACET_shoreline_lotic_erase = f"{scratch}FACET_shoreline_lotic_erase"
+    existing = existing_layers(scratch)
 
     # validate records exist
-    cnt = int(arcpy.GetCount_management(lotic_path).getOutput(0))
-    if cnt > 0:
+    if has_rows(lotic_path):
         # 1. Buffer lotic water to create lotic riparian zone
-        if not arcpy.Exists(f"{arcpy.env.workspace}/{lotic_buf}"):
+        if lotic_buf not in existing:
             arcpy.analysis.PairwiseBuffer(in_features=lotic_path, out_feature_class=lotic_buf, buffer_distance_or_field=f"{buffer_width} Meters", dissolve_option="ALL", dissolve_field=[], method="PLANAR", max_deviation="0 Meters")
 
         # 2. Remove lotic water from FACET
-        if not arcpy.Exists(f"{arcpy.env.workspace}/{FACET_shoreline_lotic_erase}"):
+        if FACET_shoreline_lotic_erase not in existing:
             arcpy.analysis.PairwiseErase(in_features=FACET_shoreline_erase, erase_features=lotic_path, out_feature_class=FACET_shoreline_lotic_erase, cluster_tolerance="")
 
         # 3. Remove lotic water from buffered lotic
-        if not arcpy.Exists(f"{arcpy.env.workspace}/{lotic_riparian}"):
+        if lotic_riparian not in existing:
             arcpy.analysis.PairwiseErase(in_features=lotic_buf, erase_features=lotic_path, out_feature_class=lotic_riparian, cluster_tolerance="")
-    else:
+    else: # no lotic - pass FACET through unchanged
         print("\t\tNo lotic in HUC")
-        arcpy.management.CopyFeatures(FACET_shoreline_erase, FACET_shoreline_lotic_erase)
+        return None, FACET_shoreline_erase
 
     # 4. Return layer names for lotic riparian and FACET
     return lotic_riparian, FACET_shoreline_lotic_erase
 
-def FACET(FACET_shoreline_lotic_erase, buffer_width):
+def FACET(FACET_shoreline_lotic_erase, buffer_width, snap_raster, scratch=""):
     """
     Method: FACET()
-    Purpose: Create FACET riparian area
+    Purpose: Create FACET riparian area as a 10-meter raster. Lines are rasterized with their buffer distance
+             (half the channel width plus the buffer) rounded to whole cells. For each distance class, cells within
+             that distance of the class's lines are kept, and the classes are unioned - so a cell is riparian if it
+             is within any line's buffer, as with polygon buffers. Nothing is written to the FACET layer, which may
+             be a shared input tile.
     Params: FACET_shoreline_lotic_erase - FACET layer to be buffered (FACET with shoreline and lotic erased)
-    Returns: facet_riparian - layer name of facet riparian
+            buffer_width - buffer width in meters
+            snap_raster - path to snap raster
+            scratch - workspace prefix for intermediates ("memory/" or "" for the huc gdb)
+    Returns: facet_riparian - raster name of facet riparian (1 in riparian area, NoData elsewhere; None if no FACET remains)
     """
     # intermediate layer names
-    facet_riparian = 'FACET_riparian'
-
-    if not arcpy.Exists(f"{arcpy.env.workspace}/{facet_riparian}"): 
-        # 1. Create field representing the channel width plus 30-m buffer area
-        lstFields = arcpy.ListFields(FACET_shoreline_lotic_erase)
-        lstFields = [field.name for field in lstFields]
-        buf_field = "Buffer"
-        if "Buffer" not in lstFields and "buffer" not in lstFields:
-            arcpy.AddField_management(FACET_shoreline_lotic_erase, 'Buffer', "DOUBLE" ) # need this to avoid database lock error ?
-
-        arcpy.management.CalculateField(in_table=FACET_shoreline_lotic_erase, field="Buffer", expression=f"(!chnwid_px!/2)+{buffer_width}", expression_type="PYTHON3", code_block="", field_type="TEXT", enforce_domains="NO_ENFORCE_DOMAINS")
+    facet_chnwid_ras = f'{scratch}FACET_chnwid_ras'
+    facet_class_ras = 'FACET_class_ras' # written to the huc gdb - its attribute table lists the distance classes
+    facet_riparian = 'FACET_riparian_ras' # written to the huc gdb
 
-        # 2. Buffer FACET
-        arcpy.analysis.PairwiseBuffer(in_features=FACET_shoreline_lotic_erase, out_feature_class=facet_riparian, buffer_distance_or_field="Buffer", dissolve_option="ALL", dissolve_field=[], method="PLANAR", max_deviation="0 Meters")
+    if not arcpy.Exists(facet_riparian):
+        # no lines to rasterize - FACET is empty or all of it was erased by shoreline and lotic
+        if not has_rows(FACET_shoreline_lotic_erase):
+            print("\t\tNo FACET in HUC")
+            return None
 
-    # 3. Return FACET riparian
+        # 1. Rasterize FACET lines with their channel width
+        arcpy.env.snapRaster = snap_raster
+        arcpy.conversion.PolylineToRaster(FACET_shoreline_lotic_erase, "chnwid_px", facet_chnwid_ras, cellsize=snap_raster)
+
+        # 2. Buffer distance (channel width plus buffer area) in whole cells - each value is a distance class
+        cell = Raster(snap_raster).meanCellWidth
+        Int((Raster(facet_chnwid_ras) / 2.0 + buffer_width) / cell + 0.5).save(facet_class_ras)
+        arcpy.management.BuildRasterAttributeTable(facet_class_ras, "Overwrite")
+        with arcpy.da.SearchCursor(facet_class_ras, ["Value"]) as cursor:
+            classes = sorted(row[0] for row in cursor)
+        if not classes: # no channel widths on the remaining lines
+            print("\t\tNo FACET widths in HUC")
+            return None
+
+        # 3. Keep cells within each class's distance of that class's lines and union the classes
+        riparian = None
+        for k in classes:
+            near = Con(IsNull(EucDistance(SetNull(Raster(facet_class_ras) != k, 1), maximum_distance=k * cell)), 0, 1)
+            riparian = near if riparian is None else riparian | near
+        SetNull(riparian == 0, 1).save(facet_riparian)
+        del riparian, near
+
+    # 4. Return FACET riparian
     return facet_riparian
 
-def createRiparian(vims_path, lotic_path, FACET_data, DE_path, snap_raster, mask_raster, output_folder, suffix, huc_extent, buffer_width):
+def createRiparian(vims_path, lotic_path, FACET_data, DE_path, snap_raster, mask_raster, output_folder, suffix, buffer_width, n_hucs):
     """
     Method: createRiparian()
     Purpose: Create 10-meter raster riparian zones.
-    Params: vims_path - path to VIMS shoreline
+    Params: vims_path - path to VIMS shoreline clipped to huc
+            DE_path - path to DE Bay shoreline clipped to huc
             lotic_path - path to lotic water
             FACET - path to FACET aligned stream network
-    Returns: N/A
+            n_hucs - number of hucs in the run; the mask is applied here only for a single huc
+    Returns: riparian_raster_tmp - path to huc riparian raster (None if the huc has no riparian layers)
     """
     # output layer names
-    rip_vector = 'riparian_vector'
     riparian_raster_tmp = f"{output_folder}/riparian_10m{suffix}_unmasked.tif"
     riparian_raster = f"{output_folder}/riparian_10m{suffix}.tif"
     if not mask_raster:
         riparian_raster_tmp = riparian_raster
 
+    # intermediates are held in memory unless FACET is too large for the huc
+    scratch = f"{SCRATCH_WS}/" if int(arcpy.GetCount_management(FACET_data).getOutput(0)) <= SCRATCH_MAX_FEATURES else ""
+
     st = timer()
     # 1. Create shoreline riparian
     print(f"\tCreating shoreline riparian zone... {datetime.datetime.now()}")
-    shoreline_riparian, FACET_shoreline_erase = shoreline(vims_path, DE_path, FACET_data, huc_extent, buffer_width)
+    shoreline_riparian, FACET_shoreline_erase = shoreline(vims_path, DE_path, FACET_data, buffer_width, scratch)
     st = time_dif(st)
 
     # 2. Create lotic riparian
     print(f"\tCreating lotic riparian zone...{datetime.datetime.now()}")
-    lotic_riparian, FACET_shoreline_lotic_erase = lotic(lotic_path, FACET_shoreline_erase, buffer_width)
+    lotic_riparian, FACET_shoreline_lotic_erase = lotic(lotic_path, FACET_shoreline_erase, buffer_width, scratch)
     st = time_dif(st)
 
     # 3. Create FACET riparian
     print(f"\tCreating FACET riparian zone...{datetime.datetime.now()}")
-    facet_riparian = FACET(FACET_shoreline_lotic_erase, buffer_width)
+    facet_riparian = FACET(FACET_shoreline_lotic_erase, buffer_width, snap_raster, scratch)
     st = time_dif(st)
 
-    # 4. Merge the 3 riparian layers into a single feature layer
-    try:
-        shoreline_cnt = int(arcpy.GetCount_management(shoreline_riparian).getOutput(0))
-    except:
-        shoreline_cnt = 0
-    try:
-        lotic_cnt = int(arcpy.GetCount_management(lotic_riparian).getOutput(0))
-    except:
-        lotic_cnt = 0      
-    if shoreline_cnt == 0 and lotic_cnt == 0:
-        in_table = facet_riparian
-    else:
-        if not arcpy.Exists(f"{arcpy.env.workspace}/{rip_vector}"): 
-            inputs = [facet_riparian]
-            if shoreline_cnt > 0:
-                inputs.append(shoreline_riparian)
-            if lotic_cnt > 0:
-                inputs.append(lotic_riparian)
-            print(f"\tMerging riparian zones...{datetime.datetime.now()}")
-            arcpy.management.Merge(inputs=inputs, output=rip_vector)
-            in_table = rip_vector
-            st = time_dif(st)
-
-    # 5. Create field to rasterize on (all are 1)
-    if "Raster" not in [field.name for field in arcpy.ListFields(in_table)]:
-        arcpy.management.CalculateField(in_table=in_table, field="Raster", expression="1", expression_type="PYTHON3", field_type="SHORT")
-
-    # 6. Rasterize at 10-meters
+    # 4. Rasterize shoreline and lotic riparian at 10-meters - FACET riparian is already a raster
+    existing = existing_layers(scratch)
+    inputs = [layer for layer in [shoreline_riparian, lotic_riparian] if layer and layer in existing and has_rows(layer)]
+
     print(f"\tCreating riparian raster ...{datetime.datetime.now()}")
     arcpy.env.snapRaster = snap_raster
     arcpy.env.compression = "LZW"
-    arcpy.PolygonToRaster_conversion(rip_vector, "Raster", riparian_raster_tmp, cellsize=snap_raster)
+    layer_rasters = [facet_riparian] if facet_riparian else []
+    for layer in inputs:
+        layer_ras = f"{layer}_ras"
+        if layer_ras not in existing:
+            arcpy.PolygonToRaster_conversion(layer, arcpy.Describe(layer).OIDFieldName, layer_ras, cellsize=snap_raster)
+        layer_rasters.append(layer_ras)
+    if not layer_rasters:
+        print("\tNo riparian in HUC")
+        return None
+
+    # 5. Union the layer rasters on the 10-meter grid - 1 where any layer is present
+    ras = Con(IsNull(Raster(layer_rasters[0])), 0, 1)
+    for layer_ras in layer_rasters[1:]:
+        ras = ras | Con(IsNull(Raster(layer_ras)), 0, 1)
+
+    # 6. Write 1-bit riparian raster
+    arcpy.management.CopyRaster(ras, 
+                                riparian_raster_tmp, 
+                                background_value=0, 
+                                nodata_value=0,
+                                pixel_type='1_BIT', 
+                                format="TIFF")
+    del ras
     st = time_dif(st)
 
     # 7. extract riparian by mask
-    if mask_raster and len(hucs) == 1: # if more than one huc, impose mask after mosaic
+    if mask_raster and n_hucs == 1: # if more than one huc, impose mask after mosaic
         ras = ExtractByMask(riparian_raster_tmp, mask_raster)
         arcpy.env.snapRaster = snap_raster
         arcpy.env.compression = "LZW"
@@ -245,6 +550,76 @@ def createRiparian(vims_path, lotic_path, FACET_data, DE_path, snap_raster, mask
                                     nodata_value=0,
                                     pixel_type='1_BIT', 
                                     format="TIFF")
+    return riparian_raster_tmp
+
+def process_huc(huc_args, n_hucs, vims_path, lotic_path, FACET_path, facet_layer, DE_path, snap_raster, mask, huc8_folder, huc_output, preclip_folder, facet_tiled, buffer_width):
+    """
+    Method: process_huc()
+    Purpose: Pool worker to create the riparian raster for a single huc. Each huc has its own gdb and
+             output raster, so hucs are processed in parallel.
+    Params: huc_args - tuple of arguments
+                i - huc number in the run (1-based)
+                huc - huc8 shapefile name
+            n_hucs - number of hucs in the run
+            vims_path - path to VIMS shoreline
+            lotic_path - path to lotic water
+            FACET_path - path to FACET gdb
+            facet_layer - FACET layer name in FACET_path
+            DE_path - path to DE Bay shoreline
+            snap_raster - path to snap raster
+            mask - path to mask raster
+            huc8_folder - path to folder of huc8 shapefiles
+            huc_output - path to huc output folder
+            preclip_folder - path to folder of shoreline pre-clipped to hucs
+            facet_tiled - path to gdb of FACET pre-clipped to hucs
+            buffer_width - buffer width in meters
+    Returns: riparian_raster - path to huc riparian raster (None if createRiparian failed or the huc has no riparian)
+    """
+    i, huc = huc_args
+    arcpy.CheckOutExtension("Spatial")
+    extent = f"{huc8_folder}/{huc}"
+    suffix = f'_{huc.split(".")[0]}' # add to end of file names
+    riparian_raster = f"{huc_output}/riparian_10m{suffix}_unmasked.tif"
+
+    print(f"\n{suffix}: {i} of {n_hucs}")
+    if os.path.isfile(riparian_raster):
+        print(f"\tRiparian is complete - skipping")
+        return riparian_raster
+
+    # clear intermediates left in memory by the previous huc in this worker
+    arcpy.management.Delete(SCRATCH_WS)
+
+    # set environment workspace and extent
+    try:
+        arcpy.CreateFileGDB_management(huc_output, f"riparian_intermediates{suffix}.gdb")
+    except:
+        print("WARNING: Geodatabase already exists. Overwriting contents.")
+        arcpy.env.overwriteOutput = True
+
+    # pre-clipped shoreline for huc (clipped in main, only clips here if missing)
+    vims_clip, de_clip = preclip_shoreline(vims_path, DE_path, extent, preclip_folder, suffix)
+
+    # pre-clipped FACET tile for huc (clipped in main, only clips here if missing)
+    facet_clip = preclip_facet(FACET_path, facet_layer, extent, facet_tiled, suffix)
+
+    # set output gdb as workspace
+    arcpy.env.workspace = f"{huc_output}/riparian_intermediates{suffix}.gdb"
+    if os.path.isfile(extent):
+        arcpy.env.extent = extent # set extent to huc8
+
+    # create riparian layer
+    st = timer()
+    try:
+        if not createRiparian(vims_clip, lotic_path, facet_clip, de_clip, snap_raster, mask, huc_output, suffix, buffer_width, n_hucs):
+            riparian_raster = None
+    except Exception as e:
+        print(f"ERROR: createRiparian failed for {suffix}/n{e}/n/n")
+        riparian_raster = None
+    time_dif(st)
+
+    arcpy.management.Delete(SCRATCH_WS)
+    arcpy.env.extent = None
+    return riparian_raster
 
 
 if __name__=="__main__":
@@ -263,7 +638,30 @@ if __name__=="__main__":
     FACET_path = f"{input_folder}/facet_plus_nhd_24k.gdb"
     facet_layer='facet_plus_nhd_24k_CopyFeatures'
     snap_raster = f"{input_folder}/environment/Phase6_Snap.tif"
-    hucs = [x for x in os.listdir(huc8_folder) if x[-3:]=='shp']
+    hucs = sorted(p.name for p in pathlib.Path(huc8_folder).glob("*.shp"))
+
+    # project inputs to the snap raster coordinate system once - projected copies are reused by every huc
+    snap_sr = arcpy.Describe(snap_raster).spatialReference
+    projected_folder = f"{input_folder}/projected"
+    os.makedirs(projected_folder, exist_ok=True)
+    vims_path, vims_projected = project_to_snap(vims_path, snap_sr, f"{projected_folder}/{os.path.basename(vims_path)}")
+    DE_path, de_projected = project_to_snap(DE_path, snap_sr, f"{projected_folder}/{os.path.basename(DE_path)}")
+    lotic_path, _ = project_to_snap(lotic_path, snap_sr, f"{projected_folder}/{os.path.basename(lotic_path)}")
+    facet_fc, facet_projected = project_to_snap(f"{FACET_path}/{facet_layer}", snap_sr, f"{FACET_path}/{facet_layer}_projected")
+    facet_layer = os.path.basename(facet_fc)
+
+    # pre-clipped shoreline and FACET tiles are keyed only by huc - clear them when their input was just projected
+    preclip_folder = f"{input_folder}/preclip"
+    facet_tiled = f"{input_folder}/facet_tiled.gdb"
+    if (vims_projected or de_projected) and os.path.isdir(preclip_folder):
+        print("Clearing shoreline pre-clips made before projection")
+        shutil.rmtree(preclip_folder)
+    if facet_projected and arcpy.Exists(facet_tiled):
+        print("Clearing FACET tiles made before projection")
+        arcpy.management.Delete(facet_tiled)
+
+    # buffers are PLANAR - inputs must be in a projected (Albers) coordinate system
+    assert arcpy.Describe(vims_path).spatialReference.type == "Projected", "Inputs must be projected for PLANAR buffers"
 
     # buffer width in meters
     buffer_width = 10
@@ -271,60 +669,59 @@ if __name__=="__main__":
     
     # optional user entry - path to extent mask
     mask = f"{input_folder}/environment/CBW_NHDv21_catchment_albers_30m_2022.tif" # CBW
-    huc_ras_list = []
-    for huc in hucs: # subset - FACET layer too large to run for region
-        extent = f"{huc8_folder}/{huc}"
-        suffix = f'_{huc.split(".")[0]}' # add to end of file names
-        riparian_raster = f"{huc_output}/riparian_10m{suffix}_unmasked.tif"
-
-        print(f"\n{suffix}: {(hucs.index(huc)+1)} of {len(hucs)}")
-        if os.path.isfile(riparian_raster):
-            print(f"\tRiparian is complete - skipping")
-            huc_ras_list.append(riparian_raster)
-            continue
-
-        # set environment workspace and extent
-        try:
-            arcpy.CreateFileGDB_management(huc_output, f"riparian_intermediates{suffix}.gdb")
-        except:
-            print("WARNING: Geodatabase already exists. Overwriting contents.")
-            arcpy.env.overwriteOutput = True
-            # continue
-
-        # subset FACET data
-        arcpy.env.workspace = FACET_path
-        facet_selection = arcpy.management.SelectLayerByLocation(facet_layer, "INTERSECT", extent)
-
-        # set output gdb as workspace
-        arcpy.env.workspace = f"{huc_output}/riparian_intermediates{suffix}.gdb"
-        if os.path.isfile(extent):
-            arcpy.env.extent = extent # set extent to huc8
-
-        # create riparian layer
-        st = timer()
-        try:
-            createRiparian(vims_path, lotic_path, facet_selection, DE_path, snap_raster, mask, huc_output, suffix, extent, buffer_width)
-            huc_ras_list.append(riparian_raster)
-        except Exception as e:
-            print(f"ERROR: createRiparian failed for {suffix}/n{e}/n/n")
-        time_dif(st)
-
-        arcpy.env.extent = None
+    # spatially index shapefile inputs and pre-clip shoreline and FACET to each huc once
+    os.makedirs(preclip_folder, exist_ok=True)
+    if not arcpy.Exists(facet_tiled):
+        arcpy.CreateFileGDB_management(input_folder, "facet_tiled.gdb")
+    for fc in [vims_path, DE_path, lotic_path]:
+        if not arcpy.Describe(fc).hasSpatialIndex:
+            arcpy.management.AddSpatialIndex(fc)
+    for huc in hucs:
+        preclip_shoreline(vims_path, DE_path, f"{huc8_folder}/{huc}", preclip_folder, f'_{huc.split(".")[0]}')
+        preclip_facet(FACET_path, facet_layer, f"{huc8_folder}/{huc}", facet_tiled, f'_{huc.split(".")[0]}')
+
+    # process hucs in parallel - subset, FACET layer too large to run for region
+    huc_worker = partial(process_huc, n_hucs=len(hucs), vims_path=vims_path, lotic_path=lotic_path, FACET_path=FACET_path, facet_layer=facet_layer,
+                         DE_path=DE_path, snap_raster=snap_raster, mask=mask, huc8_folder=huc8_folder, huc_output=huc_output, preclip_folder=preclip_folder, facet_tiled=facet_tiled, buffer_width=buffer_width)
+    with mp.Pool(processes=min(8, len(hucs))) as pool:
+        huc_ras_list = [r for r in pool.imap_unordered(huc_worker, enumerate(hucs, 1)) if r]
+        pool.close()
+        pool.join()
 
     print("\nAll Hucs Complete")
 
+    if not huc_ras_list:
+        raise SystemExit("ERROR: no huc riparian rasters were created - nothing to mosaic")
+
     # add step to mosaic tiffs - max value takes precedence
     if not os.path.isfile(f"{output_folder}/CBW_riparian_24k_unmasked_2023.tif"):
-        huc_ras_list = [Raster(rasPath) for rasPath in huc_ras_list]
-        arcpy.env.compression = "LZW"
         print(f"\n\nMosaicking {len(huc_ras_list)} huc rasters")
-        arcpy.management.MosaicToNewRaster(huc_ras_list, output_folder, "CBW_riparian_24k_unmasked_2023.tif", pixel_type="1_BIT", cellsize=10.0, number_of_bands=1, mosaic_method="MAXIMUM")
+        if USE_GDAL:
+            # virtual mosaic of the huc rasters - 0 is nodata, so any huc with riparian wins where hucs overlap (binary max)
+            mosaic_vrt = f"{output_folder}/CBW_riparian_24k_unmasked_2023.vrt"
+            vrt = gdal.BuildVRT(mosaic_vrt, huc_ras_list, options=gdal.BuildVRTOptions(resolution="user", xRes=10, yRes=10, srcNodata=0, VRTNodata=0))
+            vrt = None # close to write the vrt
+
+            # write mosaic as a tiled COG so the shoreline step reads it by block
+            to_cog(mosaic_vrt, f"{output_folder}/CBW_riparian_24k_unmasked_2023.tif")
+        else:
+            huc_ras_list = [Raster(rasPath) for rasPath in huc_ras_list]
+            arcpy.env.compression = "LZW"
+            arcpy.management.MosaicToNewRaster(huc_ras_list, output_folder, "CBW_riparian_24k_unmasked_2023_mosaic.tif", pixel_type="1_BIT", cellsize=10.0, number_of_bands=1, mosaic_method="MAXIMUM")
+
+            # write mosaic as a tiled raster so the shoreline step reads it by block
+            to_cog(f"{output_folder}/CBW_riparian_24k_unmasked_2023_mosaic.tif", f"{output_folder}/CBW_riparian_24k_unmasked_2023.tif")
+            arcpy.management.Delete(f"{output_folder}/CBW_riparian_24k_unmasked_2023_mosaic.tif")
 
     # add step to remove shorelines - new workflow clips shoreline by huc resulting is false buffers in the estuary
     vims_ras = f"{input_folder}/vims_10m.tif"
     de_ras = f"{input_folder}/de_10m.tif"
     arcpy.env.snapRaster = snap_raster
     arcpy.env.compression = "LZW"
+    # region-wide raster steps run on all cores and write tiled output
+    arcpy.env.parallelProcessingFactor = "100%"
+    arcpy.env.autoCommit = 10000
+    arcpy.env.tileSize = "512 512"
 
     if not os.path.isfile(vims_ras):
         print(f"Rasterizing VIMS ...{datetime.datetime.now()}")
@@ -335,26 +732,27 @@ if __name__=="__main__":
         arcpy.PolygonToRaster_conversion(DE_path, "Id", de_ras, cellsize=snap_raster)
 
     if not os.path.isfile(f"{output_folder}/CBW_riparian_{buffer_width}m_24k_2023.tif"):
-        arcpy.env.extent = mask
-        arcpy.env.mask = mask
-        ras = Raster(f"{output_folder}/CBW_riparian_24k_unmasked_2023.tif")
-        vims = Con(IsNull(Raster(vims_ras)), 0, 1)
-        de = Con(IsNull(Raster(de_ras)), 0, 1)
-        ras = Con(( ( vims == 1) | (de == 1) ),0,ras)
-        del vims
-        del de
-
-        # # mask mosaicked results
-        # print("Masking CBW dataset")
-        # ras = ExtractByMask(ras, mask)
-        arcpy.env.snapRaster = snap_raster
-        arcpy.env.compression = "LZW"
-        arcpy.env.extent = mask
-        print("Writing riparian layer")
-        arcpy.management.CopyRaster(ras, 
-                                    f"{output_folder}/CBW_riparian_{buffer_width}m_24k_2023.tif", 
-                                    background_value=0, 
-                                    nodata_value=0,
-                                    pixel_type='1_BIT', 
-                                    format="TIFF")
-        del ras
+        if USE_RASTERIO:
+            print("Writing riparian layer")
+            remove_shoreline(f"{output_folder}/CBW_riparian_24k_unmasked_2023.tif", vims_ras, de_ras, mask, f"{output_folder}/CBW_riparian_{buffer_width}m_24k_2023.tif")
+        else:
+            arcpy.env.extent = mask
+            arcpy.env.mask = mask
+            ras = Raster(f"{output_folder}/CBW_riparian_24k_unmasked_2023.tif")
+            # keep riparian only where neither shoreline layer is present - one pass over the rasters
+            ras = Con(IsNull(Raster(vims_ras)) & IsNull(Raster(de_ras)), ras, 0)
+
+            # # mask mosaicked results
+            # print("Masking CBW dataset")
+            # ras = ExtractByMask(ras, mask)
+            arcpy.env.snapRaster = snap_raster
+            arcpy.env.compression = "LZW"
+            arcpy.env.extent = mask
+            print("Writing riparian layer")
+            arcpy.management.CopyRaster(ras, 
+                                        f"{output_folder}/CBW_riparian_{buffer_width}m_24k_2023.tif", 
+                                        background_value=0, 
+                                        nodata_value=0,
+                                        pixel_type='1_BIT', 
+                                        format="TIFF")
+            del ras